@@ -1,40 +1,83 @@
 import operator
 import os
 import pathlib
-import io
+import mmap
 import pickle
 
 from ctypes import *
 from ctypes import LittleEndianStructure, c_uint32, c_ubyte, c_bool
 
-import collections
-from functools import total_ordering
+import collections.abc
+import itertools
 from sortedcontainers import SortedDict
 
+# the most bytes we stage for a single write when saving
+WRITE_CHUNK = 128 * 1024
+
+# the most buffers the OS accepts in a single vectored write
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+
+# compile a function from generated source
+# namespace holds any names the source refers to
+def build_function(name, source, namespace):
+    exec(compile(source, '<seaslug {}>'.format(name), 'exec'), namespace)
+    return namespace[name]
+
+
+# A property to delegate reads and writes to the value in a row to a column object
+class Property:
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, instance, owner):
+        return self.column.get(instance)
+
+    def __set__(self, instance, value):
+        column = self.column
+        # writing back a value the row already holds changes nothing
+        # so skip the index updates and leave the row clean
+        if column.unchanged(instance, value):
+            return
+        column.set(instance, value)
+
+        # if we edit a column, make the row to be written next time we save
+        # keep this after the set in case an exception is thrown
+        instance._dirty = True
+
 
 # A "virtual" column
 # This is meant to be abstract, and implement any functionality common among all column types
 
 class VColumn:
     def __init__(self, *args, **kwargs):
-        # A property to delegate reads and writes to the value in a row to our column object
-        class Property:
-            def __get__(prop, instance, owner):
-                return self.get(instance)
-
-            def __set__(prop, instance, value):
-                self.set(instance, value)
+        pass
 
-                # if we edit a column, make the row to be written next time we save
-                # keep this after the set in case an exception is thrown
-                instance._dirty = True
+    # the row attribute holding our value as is, if get does nothing more than read it
+    # lets readers skip our Python code entirely
+    def attribute(self):
+        return None
 
-        self.Property = Property
+    # the descriptor that exposes this column on rows
+    def descriptor(self):
+        attribute = self.attribute()
+        if attribute:
+            # plain reads go straight to the stored value without running any Python
+            return property(operator.attrgetter(attribute), Property(self).__set__)
+        return Property(self)
 
     # this is our earliest chance to capture which table we're on
     def __set_name__(self, owner, name):
         self.name = name
         self.table = owner
+        # the attributes a row keeps our Python value and raw ctypes value in
+        self._pub = '_' + name
+        self._priv = '__' + name
 
     def __eq__(self, other):
         return ColEq(self, other)
@@ -61,6 +104,11 @@ class VColumn:
     def set(self, row, value):
         raise NotImplementedError()
 
+    # whether setting value on the given row would leave it as it is
+    # only safe for values that can't be changed in place, so by default we always assume a change
+    def unchanged(self, row, value):
+        return False
+
 
 # A "concrete" column. That is, one that is actually stored on disk
 
@@ -71,20 +119,24 @@ class Column(VColumn):
         self.kwargs = kwargs
         super().__init__(*args, **kwargs)
 
+    def attribute(self):
+        if type(self).get is Column.get:
+            return self._pub
+
     # we store the value on the Python object for speed of access.
     def get(self, row):
-        return getattr(row, '_' + self.name)
+        return getattr(row, self._pub)
 
     # store the value, and update relevant indexes
     def set(self, row, value):
-        # find all indices on this column
-        indices = [index for index in row.table.indices if self.name in index.keys]
+        # all indices on this column, worked out when the table was made
+        indices = self._affected_indices
         # if the row isn't yet loaded that means it hasn't been indexed
         if row._loaded:
             for index in indices:
                 # remove us from the indexes
                 index.remove(row)
-        setattr(row, '_' + self.name, value)
+        setattr(row, self._pub, value)
         if row._loaded:
             for index in indices:
                 # then put us back on
@@ -119,20 +171,38 @@ class Column(VColumn):
         self.__init__(*state['args'], **state['kwargs'])
         self.name = state['name']
 
+    # the ctypes type this column is stored as inside a row
+    @property
+    def ctype(self):
+        return self.Struct
+
 
 # A Column wrapping a ctypes primitive
 class StructColumn(Column):
+    # the primitive is stored directly in the row rather than nested in our Struct
+    # the layout on disk is the same, but reads skip a level of indirection
+    @property
+    def ctype(self):
+        return self.Struct._fields_[0][1]
+
+    def attribute(self):
+        if type(self).get is StructColumn.get:
+            return self._priv
+
     def get(self, row):
-        return getattr(row, '__' + self.name).value
+        return getattr(row, self._priv)
+
+    def unchanged(self, row, value):
+        return getattr(row, self._priv) == value
 
     # Since we override the default storage we re-implement the index logic
     # Maybe replace this with a context manager?
     def set(self, row, value):
-        indices = [index for index in row.table.indices if self.name in index.keys]
+        indices = self._affected_indices
         if row._loaded:
             for index in indices:
                 index.remove(row)
-        getattr(row, '__' + self.name).value = value
+        setattr(row, self._priv, value)
         if row._loaded:
             for index in indices:
                 index.add(row)
@@ -163,11 +233,9 @@ class RemoteColumn(VColumn):
         super().__init__(remote, *args)
 
     # Find and load our table
-    def get_table(self, row):
-        for table in row.table.db.tables:
-            if table.__name__ == self.remote:
-                self._table = table
-                break
+    # row is unused, but kept so existing callers that pass one still work
+    def get_table(self, row=None):
+        self._table = self.table.db.tables_by_name.get(self.remote)
         return self._table
 
 
@@ -178,10 +246,11 @@ class ForeignColumn(StructColumn, RemoteColumn):
 
     def get(self, row):
         if not self._table:
-            self.get_table(row)
+            self.get_table()
 
-        id = getattr(row, '__' + self.name).value
-        return self._table.find(self._table.id == id)
+        id = getattr(row, self._priv)
+        # ids are unique, so the id index maps each one straight to its row
+        return self._table._id_index.get(id)
 
     def set(self, row, value):
         if value is None:
@@ -190,44 +259,48 @@ class ForeignColumn(StructColumn, RemoteColumn):
             value = value.id
         return super().set(row, value)
 
+    # compare ids, rather than looking up the row we point to
+    def unchanged(self, row, value):
+        return getattr(row, self._priv) == (0 if value is None else value.id)
+
 
 # A column that contains a byte sequence
 # This is meant to be abstract parent for classes that require variable length data
 class BytesColumn(Column):
+    # one Struct per length, shared between columns so tables with the same schema share a row layout
+    structs = {}
+
     def __init__(self, length, *args, **kwargs):
-        class Struct(LittleEndianStructure):
-            _fields_ = [('length', c_uint32), ('data', c_ubyte * length)]
+        if length not in BytesColumn.structs:
+            class Struct(LittleEndianStructure):
+                _fields_ = [('length', c_uint32), ('data', c_ubyte * length)]
+
+            BytesColumn.structs[length] = Struct
 
         self.length = length
-        self.Struct = Struct
+        self.Struct = BytesColumn.structs[length]
+        # where our data starts within our Struct
+        self._data_offset = self.Struct.data.offset
         super().__init__(length, *args, **kwargs)
 
     def store_bytes(self, row, value):
         length = len(value)
         if length > self.length:
             raise ValueError("Received string of {} bytes, maximum {}".format(length, self.length))
-        struct = getattr(row, '__' + self.name)
+        struct = getattr(row, self._priv)
         # save the length
         struct.length = length
-        # copy the data into a BytesIO for ease of access
-        b = io.BytesIO()
-        b.write(struct)
-
-        # Overwrite the data with the new stuff
-        offset = self.Struct.data.offset
-        b.getbuffer()[offset:offset + length] = value
-
-        # and copy it back into the struct
-        b.seek(0)
-        b.readinto(struct)
+        # and copy the new data straight over the old
+        data = addressof(struct) + self._data_offset
+        memmove(data, value, length)
+        # zero whatever is left of the old data so it never ends up on disk
+        memset(data + length, 0, self.length - length)
 
     def load(self, row):
         # copy the bytes out of the struct
-        b = io.BytesIO()
-        length = getattr(row, '__' + self.name).length
-        b.write(getattr(row, '__' + self.name))
-        buffer = b.getvalue()[4:4 + length]
-        return buffer
+        struct = getattr(row, self._priv)
+        length = min(struct.length, self.length)
+        return string_at(addressof(struct) + self._data_offset, length)
 
 
 # A column that stores a byte sequence in an external file
@@ -240,32 +313,42 @@ class BlobColumn(Column):
         self.Struct = Struct
         super().__init__(*args, **kwargs)
 
+    def __set_name__(self, owner, name):
+        super().__set_name__(owner, name)
+        # the directory holding our files, inside the database's
+        self._directory = owner.__name__ + '_' + name
+
     def load_col(self):
-        path = self.table.db.path.joinpath(self.table.__name__ + '_' + self.name)
+        path = self.table.db.path.joinpath(self._directory)
         os.makedirs(path, exist_ok=True)
 
     def dump_col(self):
         self.load_col()
 
     def store_bytes(self, row, value):
-        path = self.table.db.path.joinpath(self.table.__name__ + '_' + self.name, '{}.dat'.format(row._offset))
+        path = self.table.db.path.joinpath(self._directory, '{}.dat'.format(row._offset))
         if value is None:
             os.remove(path)
             return
-        file = open(path, 'wb')
-        file.write(value)
+        with open(path, 'wb') as file:
+            file.write(value)
 
     def load(self, row):
-        path = self.table.db.path.joinpath(self.table.__name__ + '_' + self.name, '{}.dat'.format(row._offset))
+        path = self.table.db.path.joinpath(self._directory, '{}.dat'.format(row._offset))
         try:
             file = open(path, 'rb')
         except IOError:
             return None
-        return file.read()
+        with file:
+            return file.read()
 
 
 # A column encoded a unicode string
 class AbstractStrColumn:
+    # strings are immutable, so an equal string really is no change
+    def unchanged(self, row, value):
+        return getattr(row, self._pub) == value
+
     def set(self, row, value):
         if value is None:
             bytes = b''
@@ -280,7 +363,7 @@ class AbstractStrColumn:
             string = ''
         else:
             string = buffer.decode()
-        setattr(row, '_' + self.name, string)
+        setattr(row, self._pub, string)
 
 
 class StrColumn(AbstractStrColumn, BytesColumn):
@@ -317,7 +400,7 @@ class AbstractPickleColumn:
             value = pickle.loads(body)
         if value is not None and self.type and not isinstance(value, self.type):
             raise ValueError("Expected {}, got {}".format(self.type, value.__class__.__name__))
-        setattr(row, '_' + self.name, value)
+        setattr(row, self._pub, value)
 
 
 class PickleColumn(AbstractPickleColumn, BytesColumn):
@@ -338,15 +421,53 @@ class PickleBlobColumn(AbstractPickleColumn, BlobColumn):
 class Through(VColumn):
     def __init__(self, *chain):
         self.chain = chain
+        # a getter for each step, for walking the chain
+        self._getters = [operator.attrgetter(next) for next in chain]
+        # the traversal compiled for our chain, built on first use once the tables along it exist
+        self._through = None
         super().__init__()
 
     def get(self, row):
-        target = row
+        if self._through is None:
+            self._through = self.build_through()
+        return self._through(row)
+
+    # work out from the columns along our chain which steps give many rows, and read the rest straight through
+    # every step after a collection applies to each of its members
+    # falls back to walking the chain if a step can't be worked out ahead of time
+    def build_through(self):
+        table = self.table
+        many = False
+        lines = []
         for next in self.chain:
-            if isinstance(target, collections.Iterable):
-                target = (getattr(i, next) for i in target)
+            if not next.isidentifier():
+                return self.walk
+            if many:
+                lines.append('    target = (i.{} for i in target)\n'.format(next))
+                continue
+            # we can't tell what a step after a plain value gives
+            if table is None:
+                return self.walk
+            lines.append('    target = target.{}\n'.format(next))
+            column = getattr(table, next, None)
+            if isinstance(column, (Belongs, ForeignColumn)):
+                many = isinstance(column, Belongs)
+                table = column._table or column.get_table()
+            elif isinstance(column, Column):
+                # a plain value; nothing more we know about
+                table = None
+            else:
+                return self.walk
+        source = 'def through(target):\n' + ''.join(lines) + '    return target\n'
+        return build_function('through', source, {})
+
+    def walk(self, row):
+        target = row
+        for getter in self._getters:
+            if isinstance(target, collections.abc.Iterable):
+                target = map(getter, target)
             else:
-                target = getattr(target, next)
+                target = getter(target)
         return target
 
 
@@ -358,7 +479,7 @@ class Belongs(RemoteColumn, VColumn):
 
     def get(self, row):
         if not self._table:
-            self.get_table(row)
+            self.get_table()
 
         key = getattr(self._table, self.key)
         return self._table.where(key == row)
@@ -371,25 +492,51 @@ class Index:
         self.keys = keys
         self.keyer = operator.attrgetter(*keys)
         self.list = SortedDict()
+        # the key each object was filed under, by identity, so removing doesn't have to work it out again
+        self.filed = {}
+
+    # read our keys straight from where the table's columns store them, rather than through the row's descriptors
+    def bind(self, columns):
+        attributes = []
+        for key in self.keys:
+            column = columns.get(key)
+            attributes.append(column and column.attribute() or key)
+        self.keyer = operator.attrgetter(*attributes)
 
     def reindex(self):
-        rows = [i for i in self.list.values()]
+        rows = list(self.list.values())
         self.list = SortedDict()
-        for i in rows:
-            self.add(i)
+        self.filed = {}
+        self.extend(rows)
 
     def add(self, object):
         key = self.keyer(object)
         self.list[key] = object
+        self.filed[id(object)] = key
+
+    # add many objects at once; much faster than adding them one by one
+    def extend(self, objects):
+        keys = list(map(self.keyer, objects))
+        self.list.update(zip(keys, objects))
+        self.filed.update(zip(map(id, objects), keys))
 
     def remove(self, object):
-        key = self.keyer(object)
-        del self.list[key]
+        del self.list[self.filed.pop(id(object))]
+
+    # the object filed under exactly this key, or None
+    def get(self, key):
+        return self.list.get(key)
 
     def find(self, start, reverse=False):
         if reverse:
-            return (self.list[i] for i in self.list.irange(maximum=start, reverse=True))
-        return (self.list[i] for i in self.list.irange(start))
+            keys = self.list.irange(maximum=start, reverse=True)
+        else:
+            keys = self.list.irange(start)
+        return map(self.list.__getitem__, keys)
+
+
+# ctypes structures laying out a row, keyed by their fields
+row_layouts = {}
 
 
 # Deep breath...
@@ -403,10 +550,14 @@ class Database:
         # generally only true following a migration
         full_dump_needed = False
 
+        # scratch space for saving on platforms without pwritev
+        _write_buffer = None
+
         # use a metaclass to make defining tables clean
         def __init_subclass__(cls, **kwargs):
             cls.rows = []
             cls.db.tables.append(cls)
+            cls.db.tables_by_name[cls.__name__] = cls
             cls.columns = []
             cls.vcolumns = []
             # copy all the columns off the child
@@ -424,14 +575,17 @@ class Database:
             # the fields for our C structure
             fields = []
             for column in cls.columns:
-                fields.append(('__' + column.name, column.Struct))
+                fields.append((column._priv, column.ctype))
 
             # little endian structure to ensure portability while being fast on most systems
             # backs the row on a C structure for efficient storage and easy dumping to/from a byte stream
-            @total_ordering
-            class Row(LittleEndianStructure):
-                # fields for our
-                _fields_ = fields
+            # tables with the same fields share one, so ctypes only has to build each layout once
+            layout = row_layouts.get(tuple(fields))
+            if layout is None:
+                layout = type('RowLayout', (LittleEndianStructure,), {'_fields_': fields})
+                row_layouts[tuple(fields)] = layout
+
+            class Row(layout):
                 table = cls
 
                 # True means we've changed and need to be written to disk
@@ -448,11 +602,21 @@ class Database:
                 def _dirty(self, value):
                     if value == self.__dirty:
                         return
-                    if self._loaded:
-                        cls._dirty_index.remove(self)
                     self.__dirty = value
                     if self._loaded:
-                        cls._dirty_index.add(self)
+                        if value:
+                            cls._dirty_rows[id(self)] = self
+                        else:
+                            del cls._dirty_rows[id(self)]
+
+                # mark rows as written to disk in one go, rather than one _dirty flip at a time
+                # every dirty row has to be among them, since we forget them all
+                @staticmethod
+                def saved(rows):
+                    for row in rows:
+                        row.__dirty = False
+                        row._new = False
+                    cls._dirty_rows.clear()
 
                 def __init__(self):
                     super().__init__()
@@ -461,75 +625,117 @@ class Database:
                     # take the next available ID
                     cls.max_id += 1
                     self.id = cls.max_id
-                    # actually store us on the table
-                    self.table.rows.append(self)
                     # _offset is where we're written to disk
                     # we should be tightly packed, so next spot is just past the last
-                    self._offset = self.table.max('_offset', -1) + 1
+                    # rows is kept in offset order, so that's simply how many rows there are
+                    self._offset = len(cls.rows)
+                    # actually store us on the table
+                    # keeping rows in offset order also lets destroy fill gaps without searching
+                    cls.rows.append(self)
                     # index ourselves
-                    for column in cls.columns:
+                    for column in cls._loadable_columns:
                         column.load(self)
                     for index in self.table.indices:
                         index.add(self)
                     self._loaded = True
                     # dirty because we're a new row so we aren't on disk yet
-                    self._dirty = True
+                    self.__dirty = True
+                    cls._dirty_rows[id(self)] = self
 
                 # delete the row
                 def destroy(self):
                     for index in cls.indices:
                         index.remove(self)
-                    cls.rows.remove(self)
-                    # give our spot on disk to the last entry
-                    offset_index = cls.find_index('_offset')
-                    try:
-                        max = next(iter(offset_index.find(None, True)))
-                        # this should only be false if we're the very last row
-                        if max._offset > self._offset:
-                            offset_index.remove(max)
-                            # so now we write them to our spot
-                            max._offset = self._offset
-                            # and mark them to be written next write
-                            max._dirty = True
-                            offset_index.add(max)
-                    except StopIteration:
-                        # this means the db is empty. Oh well!
-                        pass
+                    # we're gone, so there's nothing left to write
+                    cls._dirty_rows.pop(id(self), None)
+                    # and stop tracking us, so a stray edit can't write over whoever takes our spot
+                    self._loaded = False
+                    # rows are kept in offset order, so the last row is the one furthest out on disk
+                    max = cls.rows.pop()
+                    # this should only be false if we're the very last row
+                    if max is not self:
+                        # give our spot in the list and on disk to the last entry
+                        offset_index = cls.find_index('_offset')
+                        offset_index.remove(max)
+                        # so now we write them to our spot
+                        max._offset = self._offset
+                        cls.rows[self._offset] = max
+                        # and mark them to be written next write
+                        max._dirty = True
+                        offset_index.add(max)
 
                 # these two are so we can use a row as on index key
                 # useful to index foreigncolumns
                 def __eq__(self, other):
                     return other is not None and self.id == other.id
 
+                # all spelled out rather than derived, since index lookups compare rows a lot
+                # None columns sort before every row
                 def __lt__(self, other):
-                    # need to deal with None columns
                     if other is None:
                         return False
-                    else:
-                        return self.id < other.id
+                    return self.id < other.id
+
+                def __le__(self, other):
+                    if other is None:
+                        return False
+                    return self.id <= other.id
+
+                def __gt__(self, other):
+                    if other is None:
+                        return True
+                    return self.id > other.id
+
+                def __ge__(self, other):
+                    if other is None:
+                        return True
+                    return self.id >= other.id
 
                 def __hash__(self):
                     return hash(cls.__name__ + str(self.id))
 
             # attach properties to the row for easy access
             for column in cls.columns + cls.vcolumns:
-                setattr(Row, column.name, column.Property())
+                setattr(Row, column.name, column.descriptor())
             cls.Row = Row
             cls.max_id = 0
             indices = getattr(cls, 'indices', [])
 
             # all indices end with id to guarantee unique keys
             # default indices
-            cls.indices = [Index('id'), Index('_offset', 'id'), Index('_dirty', 'id')]
+            cls.indices = [Index('id'), Index('_offset', 'id')]
             # and the ones from the subclass
             for index in indices:
                 cls.indices.append(Index(*index, 'id'))
 
-            # for easy access
-            cls._dirty_index = cls.find_index('_dirty')
+            columns = {column.name: column for column in cls.columns}
+            for index in cls.indices:
+                index.bind(columns)
+
+            # let each column know which indices need updating when it changes
+            for column in cls.columns:
+                column._affected_indices = [index for index in cls.indices if column.name in index.keys]
+
+            # best index for each query shape, filled in by find_index
+            cls._index_cache = {}
+            # the index on id alone, for looking rows up by id
+            cls._id_index = cls.find_index('id')
+            # compiled query tests for each query shape, filled in by predicate
+            cls._predicate_cache = {}
+
+            # rows changed since the last save
+            # keyed by identity, since a row's id can change while it's dirty
+            cls._dirty_rows = {}
+
+            # only these columns do anything when a row is written
+            cls._dumpable_columns = [column for column in cls.columns if type(column).dump is not Column.dump]
+            # or loaded
+            cls._loadable_columns = [column for column in cls.columns if type(column).load is not Column.load]
 
             # save our schema for migrations
             cls.col_dump = pickle.dumps(cls.columns, 4)
+            # the header of our file is the schema's length, then the schema itself
+            cls._header = len(cls.col_dump).to_bytes(4, byteorder='little') + cls.col_dump
 
         @classmethod
         def load(cls, dir):
@@ -550,24 +756,32 @@ class Database:
             if schema != cls.col_dump:
                 cls.import_data(dir, schema)
                 return
-            # keep track of the offset each row came from
-            offset = 0
-            while file.peek():
-                row = cls.Row()
-                file.readinto(row)
+            # the rest of the file is rows packed back to back, so map it and let ctypes
+            # copy the rows straight out of the page cache, with no intermediate bytes object
+            # rows own their memory so unsaved edits never leak into the file
+            header_offset = schema_len + 4
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                count, extra = divmod(len(mm) - header_offset, sizeof(cls.Row))
+                # a partial row means the file was cut off or written by something else
+                if extra:
+                    raise ValueError("{} ends with {} bytes of a partial row".format(path, extra))
+                rows = list((cls.Row * count).from_buffer_copy(mm, header_offset))
+            # each row's offset is simply where it sat in the file
+            # the rows never went through Row.__init__, so set up what it would have
+            for offset, row in enumerate(rows):
                 row._offset = offset
-                offset += 1
-                # load all the columns to let them do any processing they need
-                for column in cls.columns:
+                # load the columns that need it to let them do any processing they need
+                for column in cls._loadable_columns:
                     column.load(row)
-                # index the row
-                for index in cls.indices:
-                    index.add(row)
                 # the row just came off the disk, so we know it hasn't been changed
-                row._dirty = False
                 row._new = False
-            # and our max id is the highest ID loaded
-            cls.max_id = max((i.id for i in cls.rows), default=0)
+                row._loaded = True
+            # and index everything in one go rather than a row at a time
+            for index in cls.indices:
+                index.extend(rows)
+            cls.rows.extend(rows)
+            # and our max id is the highest ID loaded, which the id index already knows
+            cls.max_id = cls.max('id', 0)
 
         # here we make a new table from the schema and copy it over
         @classmethod
@@ -579,21 +793,46 @@ class Database:
             copy = type(cls.__name__, cls.__bases__, d)
             # Get out of my db imposter! >:O
             cls.db.tables.remove(copy)
+            cls.db.tables_by_name[cls.__name__] = cls
             # Since this is made from the file schema, it shouldn't need to import
+            # our pickled schema may not come out byte for byte the same as the file's, so take the file's
+            copy.col_dump = schema
             copy.load(path)
-            their_columns = set(d.keys())
-            their_columns.add('id')
             for column in cls.columns:
                 column.load_col()
-            for row in copy.rows:
-                ours = cls.Row()
-                for column in cls.columns:
-                    # copy any repeat columns
-                    if column.name in their_columns:
-                        setattr(ours, column.name, getattr(row, column.name))
-                    # and we need to load all ours
+            # columns stored the same way in both schemas can have their bytes copied straight across
+            # the rest go through their descriptors, as a user would set them
+            theirs = {column.name: column for column in copy.columns}
+            copies = []
+            converted = []
+            for column in cls.columns:
+                their = theirs.get(column.name)
+                if their is None:
+                    continue
+                if type(their) is type(column) and their.ctype is column.ctype:
+                    field = getattr(cls.Row, column._priv)
+                    copies.append((field.offset, getattr(copy.Row, their._priv).offset, field.size))
+                else:
+                    converted.append(column.name)
+            # build the rows the way load does, then fill them in
+            rows = list((cls.Row * len(copy.rows))())
+            for offset, (ours, row) in enumerate(zip(rows, copy.rows)):
+                ours._offset = offset
+                # not indexed yet, so setting columns shouldn't try to update indices
+                ours._loaded = False
+                for dest, source, size in copies:
+                    memmove(addressof(ours) + dest, addressof(row) + source, size)
+                # load all ours that do anything on load, so the rest can be set over them
+                for column in cls._loadable_columns:
                     column.load(ours)
+                for name in converted:
+                    setattr(ours, name, getattr(row, name))
                 ours._new = False
+                ours._loaded = True
+            for index in cls.indices:
+                index.extend(rows)
+            cls.rows.extend(rows)
+            cls.max_id = cls.max('id', 0)
             # and on save we need to overwrite the schema and save every row
             cls.full_dump_needed = True
 
@@ -610,41 +849,80 @@ class Database:
                 return cls.save_all(path)
             # byte length of each row for seeking purposes
             size = sizeof(cls.Row)
-            # list of all dirty columns
-            dirty = [i for i in cls._dirty_index.find((True,))]
+            # list of all dirty rows, in the order they sit on disk
+            dirty = sorted(cls._dirty_rows.values(), key=operator.attrgetter('_offset'))
             # and skip over the header
-            header_offset = len(cls.col_dump) + 4
+            header_offset = len(cls._header)
             for column in cls.columns:
                 column.dump_col()
             for row in dirty:
-                file.seek(row._offset * size + header_offset)
-                for column in cls.columns:
+                for column in cls._dumpable_columns:
                     column.dump(row)
-                file.write(row)
-                row._dirty = False
-                row._new = False
-            highest_offset = cls.max('_offset', -1) + 1
+            # rows next to each other on disk get written with a single call
+            for run in cls.runs(dirty):
+                cls.write_run(file, run, run[0]._offset * size + header_offset)
+            cls.Row.saved(dirty)
             # and if the file got shorter, cut off the unneeded bytes
-            file.truncate(highest_offset * size + header_offset)
+            file.truncate(len(cls.rows) * size + header_offset)
+
+        # split rows sorted by offset into runs of consecutive offsets
+        # runs are capped so a run never exceeds our write buffer or the OS's iovec limit
+        @classmethod
+        def runs(cls, rows):
+            limit = max(1, min(IOV_MAX, WRITE_CHUNK // sizeof(cls.Row)))
+            run = []
+            for row in rows:
+                if run and (row._offset != run[-1]._offset + 1 or len(run) == limit):
+                    yield run
+                    run = []
+                run.append(row)
+            if run:
+                yield run
+
+        # write a run of consecutive rows starting at position in one syscall
+        @classmethod
+        def write_run(cls, file, run, position):
+            size = sizeof(cls.Row)
+            if hasattr(os, 'pwritev'):
+                if os.pwritev(file.fileno(), run, position) == len(run) * size:
+                    return
+            # no vectored writes here, or they came up short, so stage the rows in a reusable buffer instead
+            # rewriting bytes that did make it is harmless, and a buffered write keeps going until it's all written
+            if cls._write_buffer is None:
+                cls._write_buffer = bytearray(max(WRITE_CHUNK, size))
+            buffer = memoryview(cls._write_buffer)
+            for i, row in enumerate(run):
+                buffer[i * size:(i + 1) * size] = memoryview(row).cast('B')
+            file.seek(position)
+            file.write(buffer[:len(run) * size])
 
         @classmethod
         def save_all(cls, path):
             file = open(path, 'w+b')
-            length = len(cls.col_dump)
-            file.write(length.to_bytes(4, byteorder='little'))
-            file.write(cls.col_dump)
-            ordered = [i for i in cls.find_index('_offset').find(None)]
+            # rows is kept in offset order
+            ordered = cls.rows
             for row in ordered:
-                for column in cls.columns:
+                for column in cls._dumpable_columns:
                     column.dump(row)
-                file.write(row)
-                row._dirty = False
+            # the rows are already laid out as they'll be on disk, so join them and the header into one write
+            file.write(b''.join([cls._header] + ordered))
+            cls.Row.saved(ordered)
             cls.full_dump_needed = False
 
         # find the best index for a search
         # we define best as the most columns we can index the query against
         @classmethod
         def find_index(cls, keys, cmpkeys=[]):
+            # a lone key can be passed as a plain string
+            if isinstance(keys, str):
+                keys = (keys,)
+            keys = frozenset(keys)
+            cmpkeys = frozenset(cmpkeys)
+            # our indices never change after the table is made, so neither does the answer
+            try:
+                return cls._index_cache[keys, cmpkeys]
+            except KeyError:
+                pass
             match = -1
             best_index = None
             for index in cls.indices:
@@ -662,6 +940,7 @@ class Database:
                 if strength > match:
                     match = strength
                     best_index = index
+            cls._index_cache[keys, cmpkeys] = best_index
             return best_index
 
         # query the db
@@ -680,6 +959,8 @@ class Database:
             # the tests that should always be true in the chosen range
             # if any fail that means we've moved past any possible matches and can quit
             index_matches = []
+            # the tests our starting point already guarantees, so they never need checking
+            covered = []
             for key in index.keys:
                 # if any keyed equalities fail, that means we've moved past
                 if key in eq_names:
@@ -696,11 +977,14 @@ class Database:
                     else:
                         # for a > search, we start at the minimum value
                         start.append(comp.value)
+                        # which is all a >= search needs
+                        if isinstance(comp, ColGe):
+                            covered.append(comp)
                     break
                 else:
                     break
 
-            loose_matches = [i for i in eq + cmp if i not in index_matches]
+            loose_matches = [i for i in eq + cmp if i not in index_matches and i not in covered]
 
             if len(index.keys) == 1:
                 if start:
@@ -710,13 +994,41 @@ class Database:
                     start = None
             else:
                 start = tuple(start)
-            for entry in index.find(start):
-                # these will always be true until we exit the range where a match is possible
-                if not all(i.match(entry) for i in index_matches):
-                    break
-                # and here we verify the entry matches every test
-                if all(i.match(entry) for i in loose_matches):
-                    yield entry
+            entries = index.find(start)
+            # these will always be true until we exit the range where a match is possible
+            in_range = cls.predicate(index_matches)
+            if in_range:
+                entries = itertools.takewhile(in_range, entries)
+            # and here we verify the entry matches every remaining test
+            # comparisons without a symbol can't be compiled, so they're tested through their own match
+            compiled = [i for i in loose_matches if i.symbol is not None]
+            matches = cls.predicate(compiled)
+            if matches:
+                entries = filter(matches, entries)
+            for comp in loose_matches:
+                if comp.symbol is None:
+                    entries = filter(comp.match, entries)
+            yield from entries
+
+        # build a function testing whether a row passes every comparison, or None if there are none
+        # the code is generated once per shape of query, then bound to each query's values
+        @classmethod
+        def predicate(cls, comparisons):
+            if not comparisons:
+                return None
+            shape = tuple((comp.key, type(comp)) for comp in comparisons)
+            try:
+                factory = cls._predicate_cache[shape]
+            except KeyError:
+                values = ', '.join('value_{}'.format(i) for i in range(len(comparisons)))
+                tests = ' and '.join('row.{} {} value_{}'.format(comp.key, comp.symbol, i)
+                                     for i, comp in enumerate(comparisons))
+                source = ('def factory({}):\n'
+                          '    def predicate(row):\n'
+                          '        return {}\n'
+                          '    return predicate\n').format(values, tests)
+                factory = cls._predicate_cache[shape] = build_function('factory', source, {})
+            return factory(*(comp.value for comp in comparisons))
 
         # simple wrapper for where to return 1 entry or None
         @classmethod
@@ -735,21 +1047,30 @@ class Database:
         # finds the maximum of an indexed value in the table, or a default
         @classmethod
         def max(cls, key, default=None):
-            try:
-                index = cls.find_index(key)
-                max = next(iter(index.find(None, True)))
-                return getattr(max, key)
-            except StopIteration:
+            # rows is kept in offset order, so the last one is furthest out
+            if key == '_offset':
+                return cls.rows[-1]._offset if cls.rows else default
+            index = cls.find_index(key)
+            if not index.list:
                 return default
+            # the last entry of the index holds the maximum
+            return getattr(index.list.peekitem(-1)[1], key)
 
     def __init__(self):
         self.Table.db = self
         self.tables = []
+        # the same tables, by name, for resolving remote columns
+        self.tables_by_name = {}
 
     # connect the db to a directory
     def connect(self, path):
         self.path = pathlib.Path(path)
         os.makedirs(self.path, exist_ok=True)
+        # point remote columns at their tables up front rather than on their first read
+        for table in self.tables:
+            for column in table.columns + table.vcolumns:
+                if isinstance(column, RemoteColumn) and not column._table:
+                    column.get_table()
         for table in self.tables:
             table.load(self.path)
         # and because RemoteColumns may not work until all tables are loaded, we need to reindex
@@ -763,33 +1084,42 @@ class Database:
 
 
 class ColCmp:
+    # the operator we test with, as written in Python source for compiled queries
+    symbol = None
+    # and as a function, for testing a single row
+    op = None
+
     def __init__(self, col, value):
         self.key = col.name
         self.col = col
         self.value = value
 
+    # where() tests rows with Table.predicate; this is kept for testing a single row by hand
+    def match(self, row):
+        return self.op(self.col.get(row), self.value)
+
 
 # simple comparison classes for queries
 class ColEq(ColCmp):
-    def match(self, row):
-        return self.col.get(row) == self.value
+    symbol = '=='
+    op = operator.eq
 
 
 class ColGt(ColCmp):
-    def match(self, row):
-        return self.col.get(row) > self.value
+    symbol = '>'
+    op = operator.gt
 
 
 class ColLt(ColCmp):
-    def match(self, row):
-        return self.col.get(row) < self.value
+    symbol = '<'
+    op = operator.lt
 
 
 class ColGe(ColCmp):
-    def match(self, row):
-        return self.col.get(row) >= self.value
+    symbol = '>='
+    op = operator.ge
 
 
 class ColLe(ColCmp):
-    def match(self, row):
-        return self.col.get(row) <= self.value
+    symbol = '<='
+    op = operator.le